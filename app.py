@@ -1,8 +1,16 @@
-from flask import Flask, request, json, jsonify
+from flask import Flask, request, json, jsonify, make_response, abort
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy import exc
-from models import db, connect_db, User, Audio, Tick
+from flask_migrate import Migrate
+from sqlalchemy import exc, text
+from werkzeug.http import is_resource_modified
+import click
+from models import db, connect_db, User, Audio, Tick, Change, ChangeFeedState
+from limits import IngestLimiter, MemoryBucketStore, SQLiteBucketStore
+from similarity import TickIndex
+from itertools import groupby
+from datetime import datetime, timedelta
 import os
+import time
 
 uri = os.environ.get('DATABASE_URL', 'postgresql:///cl_backend')
 
@@ -23,14 +31,148 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'hear_clearly')
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+migrate = Migrate(app, db)
 
 db.create_all()
 
+# Ingest admission control. 
+# RATE_LIMIT_BACKEND=sqlite shares buckets between workers on this host through RATE_LIMIT_PATH.
+# INGEST_MAX_CONCURRENT should stay below the SQLAlchemy pool size (5 + 10 overflow by default).
+if os.environ.get('RATE_LIMIT_BACKEND') == 'sqlite':
+    bucket_store = SQLiteBucketStore(os.environ.get('RATE_LIMIT_PATH', '/tmp/cl_rate_limits.db'))
+else:
+    bucket_store = MemoryBucketStore()
+
+limiter = IngestLimiter(
+    bucket_store,
+    rate = float(os.environ.get('INGEST_RATE', 5)),
+    capacity = float(os.environ.get('INGEST_BURST', 20)),
+    user_rate = float(os.environ.get('INGEST_USER_RATE', 2)),
+    user_capacity = float(os.environ.get('INGEST_USER_BURST', 10)),
+    max_concurrent = int(os.environ.get('INGEST_MAX_CONCURRENT', 10)),
+    user_exists = lambda user_id: isinstance(user_id, int) and db.session.query(User.id).filter(User.id == user_id).first() is not None
+)
+
+# Session similarity index, built on the first similarity request and refreshed by the audio write routes.
+# It is not built at import so `flask db upgrade`, CLI commands, and tests don't read every tick.
+# Each worker holds its own copy and catches up on other workers' writes from the change feed.
+tick_index = TickIndex()
+
+def read_tick_rows():
+    """
+        Reads every session's ticks in a single ordered query, plus the change feed cursor they are current to.
+        The cursor is read first, so any write the tick query misses is replayed from the feed.
+
+    """
+
+    cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+    rows = db.session.query(Tick.session_id, Tick.tick).order_by(Tick.session_id, Tick.ticks_id).all()
+
+    return cursor, (
+        (session_id, [float(row.tick) for row in ticks]) 
+        for session_id, ticks in groupby(rows, key=lambda row: row.session_id)
+    )
+
+def load_tick_index():
+    """
+        Rebuilds the similarity index from the database.
+
+    """
+
+    tick_index.rebuild(read_tick_rows)
+
+def refresh_tick_index():
+    """
+        Builds the index on first use, then applies audio changes from the feed since its cursor.
+        Rebuilds instead if compaction has removed entries the index hasn't seen.
+
+    """
+
+    tick_index.ensure_loaded(read_tick_rows)
+
+    state = ChangeFeedState.query.get(1)
+    if state and state.compacted_through > tick_index.cursor:
+        load_tick_index()
+        return
+
+    changes = Change.query.filter(Change.entity == 'audio', Change.id > tick_index.cursor).order_by(Change.id).all()
+
+    tick_index.catch_up(
+        (change.id, change.entity_id, change.action, change.payload.get('ticks')) for change in changes
+    )
+
 
 @app.route('/')
 def home_page():
     return "Ground Control to Major Tom"
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+        Returns the ingest limiter's counters and settings as JSON.
+
+    """
+
+    return jsonify(limiter.metrics())
+
+# CONDITIONAL GET HELPERS
+
+def conditional_response(body, etag, last_modified, status=200):
+    """
+        Wraps a response body with the ETag and Last-Modified headers for a versioned row.
+
+    """
+
+    resp = make_response(body, status)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+
+    return resp
+
+def not_modified(etag, last_modified):
+    """
+        Returns a 304 response if the client's If-None-Match/If-Modified-Since still match, otherwise None.
+
+    """
+
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+
+    return conditional_response('', etag, last_modified, 304)
+
+# CHANGE FEED HELPERS
+
+# Arbitrary key for the advisory lock that orders outbox inserts.
+CHANGE_FEED_LOCK = 4242
+
+def record_change(entity, entity_id, action, payload):
+    """
+        Adds an outbox row for a write to the current transaction. The caller commits.
+
+        The transaction-level advisory lock is held until that commit, so outbox ids become visible 
+        in increasing order and a consumer reading "since" a cursor never skips a later-committing row.
+
+    """
+
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CHANGE_FEED_LOCK})
+    db.session.add(Change(entity = entity, entity_id = entity_id, action = action, payload = payload))
+
+def user_payload(user):
+    return {'id': user.id, 'name': user.name, 'email': user.email, 'address': user.address, 'image': user.image}
+
+def audio_payload(audio, ticks=None):
+    payload = {
+        'session_id': audio.session_id,
+        'user_id': audio.user_id,
+        'selected_tick': audio.selected_tick,
+        'step_count': audio.step_count
+    }
+
+    if ticks is not None:
+        payload['ticks'] = ticks
+
+    return payload
+
 # USERS API ROUTES [POST, GET, PATCH, DELETE]
 
 @app.route('/api/users', methods=['POST'])
@@ -61,6 +203,9 @@ def create_user():
         )
 
         db.session.add(new_user)
+        db.session.flush()
+
+        record_change('user', new_user.id, 'create', user_payload(new_user))
         db.session.commit()
 
         return f"User created {new_user}"
@@ -74,14 +219,22 @@ def get_user(user_id):
 
     """
         Given a user_id, return the user's basic information as a string.
+        Responds 304 when the client's ETag still matches the user's version.
     
     """
 
+    # Only the version columns are read before deciding whether to send a body.
+    version, updated_at = db.session.query(User.version, User.updated_at).filter(User.id == user_id).first_or_404()
+
+    cached = not_modified(f"user-{user_id}-{version}", updated_at)
+    if cached:
+        return cached
+
     user = User.query.get_or_404(user_id)
 
     # This could be returned as formatted JSON instead.
     # We can also call a helper function to restore the audio data.   
-    return f"User retrieved: {user}" 
+    return conditional_response(f"User retrieved: {user}", f"user-{user_id}-{user.version}", user.updated_at)
 
 @app.route('/api/users/<int:user_id>', methods=['PATCH'])
 def update_user(user_id):
@@ -101,7 +254,9 @@ def update_user(user_id):
     user.email = request.args.get('email') or user.email
     user.address = request.args.get('address') or user.address
     user.image = request.args.get('image') or user.image
+    user.touch()
 
+    record_change('user', user.id, 'update', user_payload(user))
     db.session.commit()
 
     return f"Updated {user}"
@@ -115,15 +270,24 @@ def delete_user(user_id):
     """
 
     user = User.query.get_or_404(user_id)
+    session_ids = [audio.session_id for audio in user.audio]
+
+    for session_id in session_ids:
+        record_change('audio', session_id, 'delete', {'session_id': session_id, 'user_id': user_id})
+    record_change('user', user_id, 'delete', {'id': user_id})
 
     db.session.delete(user)
     db.session.commit()
 
+    for session_id in session_ids:
+        tick_index.remove(session_id)
+
     return f"User {user_id} deleted"
 
 # AUDIO API ROUTES [POST, GET, PATCH]
 
 @app.route('/api/audio', methods=['POST'])
+@limiter.limit
 def insert_audio_data():
     """
         
@@ -150,6 +314,9 @@ def insert_audio_data():
 
         Ticks are stored in their own, related table. 
 
+        Requests beyond the per IP or per user rate return a 429, and requests over the 
+        concurrency cap return a 503, both with a Retry-After header.
+
         Returns the audio data as a string.
  
     """
@@ -193,9 +360,13 @@ def insert_audio_data():
            return "Error adding tick data"
 
         db.session.add(new_audio)
+
+        record_change('audio', session_id, 'create', audio_payload(new_audio, [float(tick) for tick in ticks]))
         
         db.session.commit()
 
+        tick_index.upsert(session_id, [float(tick) for tick in ticks])
+
         return f"Audio data created {new_audio}"
   
     except exc.IntegrityError:
@@ -209,7 +380,10 @@ def get_audio_data_by_user(user_id):
     
     """
     
-    audio = Audio.query.get_or_404(Audio.user_id == user_id).all()
+    audio = Audio.query.filter(Audio.user_id == user_id).all()
+
+    if not audio:
+        abort(404)
 
     # return f"Audio data for user #{user_id} : {Audio.__repr__(audio)}"
     return f"Here's the data for user #{user_id}'s sessions: {audio}"
@@ -219,12 +393,42 @@ def get_audio_data_by_session(session_id):
     """
         Given a session_id, return the audio data as a string.
         Doubles as a search route, returning a 404 if there is no such session. 
+        Responds 304 when the client's ETag still matches the session's version, without loading ticks.
     
     """
+
+    version, updated_at = db.session.query(Audio.version, Audio.updated_at).filter(Audio.session_id == session_id).first_or_404()
+
+    cached = not_modified(f"audio-{session_id}-{version}", updated_at)
+    if cached:
+        return cached
     
     audio = Audio.query.get_or_404(session_id)
 
-    return f"Here's the session: \n {audio}"
+    return conditional_response(f"Here's the session: \n {audio}", f"audio-{session_id}-{audio.version}", audio.updated_at)
+
+@app.route('/api/audio/session/<int:session_id>/similar', methods=['GET'])
+def get_similar_sessions(session_id):
+    """
+        Given a session_id, return the k sessions whose tick curves are closest to it (euclidean distance) as JSON.
+        Accepts k as a query param, from 1 to 100 (default 5). 
+        Returns a 404 if there is no such session.
+    
+    """
+
+    k = min(max(request.args.get('k', 5, type=int), 1), 100)
+
+    refresh_tick_index()
+
+    if session_id not in tick_index:
+        Audio.query.get_or_404(session_id)
+        tick_index.upsert(session_id, Tick.compile_ticks_by_session(session_id))
+
+    similar = tick_index.similar(session_id, k)
+
+    return jsonify(session_id=session_id, similar=[
+        {'session_id': similar_id, 'distance': distance} for similar_id, distance in similar
+    ])
 
 @app.route('/api/audio/update/<int:session_id>', methods=['PATCH'])
 def update_audio_data(session_id):
@@ -248,7 +452,7 @@ def update_audio_data(session_id):
     elif int(request.args.get('step_count')) not in range(0, 10):
         return "Step count must be between 0 and 9"
     else:
-        audio.step_count = request.args.get('step_count')
+        audio.step_count = int(request.args.get('step_count'))
 
     # Check for a valid new selected_tick value
     if not request.args.get('selected_tick'):
@@ -256,7 +460,7 @@ def update_audio_data(session_id):
     elif int(request.args.get('selected_tick')) not in range(0, 15):
         return "Selected tick must be between 0 and 14"
     else:
-        audio.selected_tick = request.args.get('selected_tick')
+        audio.selected_tick = int(request.args.get('selected_tick'))
  
     # Check to see if new ticks were supplied
     if not request.args.get('ticks'):
@@ -274,7 +478,7 @@ def update_audio_data(session_id):
             
             return f"Ticks must be an array of 15 values"
          
-        original_ticks = Tick.query.filter(Tick.session_id == session_id).all()
+        original_ticks = Tick.query.filter(Tick.session_id == session_id).order_by(Tick.ticks_id).all()
 
         for t in range (0, 15):
             if updated_ticks[t] > -10.0 or updated_ticks[t] < -100.0:
@@ -282,11 +486,81 @@ def update_audio_data(session_id):
 
             original_ticks[t].tick = updated_ticks[t]
  
+    audio.touch()
+
+    record_change('audio', session_id, 'update', audio_payload(audio, updated_ticks if request.args.get('ticks') else None))
     db.session.commit()
 
+    if request.args.get('ticks'):
+        tick_index.upsert(session_id, updated_ticks)
+
     return f"Updated {audio}"
     
     
+# CHANGE FEED ROUTE [GET]
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """
+        Returns user and audio writes after the "since" cursor (default 0) as JSON, oldest first.
+        Accepts "limit" (1 to 1000, default 100) and "wait" in seconds (0 to 30, default 0). 
+        With a wait, the request long-polls until a change arrives or the wait runs out.
+        
+        The response's "cursor" is the value to pass as "since" next time. 
+        "truncated" is true when entries after "since" have been compacted away, and the consumer should rescan.
+
+    """
+
+    since = request.args.get('since', 0, type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 30)
+    deadline = time.monotonic() + wait
+
+    while True:
+        changes = Change.query.filter(Change.id > since).order_by(Change.id).limit(limit).all()
+
+        if changes or time.monotonic() >= deadline:
+            break
+
+        # End the transaction so the pooled connection is released while we sleep.
+        db.session.rollback()
+        time.sleep(0.5)
+
+    # Read after the page so a compaction that lands in between is still reported.
+    state = ChangeFeedState.query.get(1)
+    compacted_through = state.compacted_through if state else 0
+
+    return jsonify(
+        changes = [change.serialize() for change in changes],
+        cursor = changes[-1].id if changes else since,
+        truncated = since < compacted_through
+    )
+
+@app.cli.command('compact-changes')
+def compact_changes():
+    """
+        Deletes change feed entries older than CHANGE_RETENTION_DAYS (default 7).
+        Records the largest deleted id so the feed can tell consumers whose cursor is behind it.
+        Run from cron, e.g. `flask compact-changes`.
+
+    """
+
+    cutoff = datetime.utcnow() - timedelta(days=float(os.environ.get('CHANGE_RETENTION_DAYS', 7)))
+
+    through = db.session.query(db.func.max(Change.id)).filter(Change.created_at < cutoff).scalar()
+    deleted = 0
+
+    if through is not None:
+        deleted = Change.query.filter(Change.id <= through).delete(synchronize_session=False)
+
+        state = ChangeFeedState.query.get(1) or ChangeFeedState(id = 1, compacted_through = 0)
+        state.compacted_through = max(state.compacted_through, through)
+        db.session.add(state)
+
+    db.session.commit()
+
+    click.echo(f"Compacted {deleted} change feed entries")
+
 # USERS API SEARCH ROUTES [GET by id, name, email, or address]
 # These items can be condensed into a single route with a query string.
 
@@ -0,0 +1,223 @@
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import make_response, request
+
+
+class BucketStoreBusy(Exception):
+    """
+        Raised when a bucket store can't answer quickly; the limiter sheds the request rather than waiting.
+
+    """
+
+
+class MemoryBucketStore:
+    """
+        Token buckets kept in this process's memory.
+        Each gunicorn/flask worker gets its own set of buckets.
+
+        Each bucket remembers when it will be full again. Every sweep_interval seconds, buckets past that
+        time are dropped; a missing bucket starts full, so eviction never changes a decision.
+
+    """
+
+    def __init__(self, sweep_interval=10):
+        self.buckets = {}
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        """
+            Spends one token from the bucket for key.
+            Returns (allowed, retry_after_seconds).
+
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            if now - self.last_sweep >= self.sweep_interval:
+                self.buckets = {k: bucket for k, bucket in self.buckets.items() if bucket[2] > now}
+                self.last_sweep = now
+
+            tokens, updated, full_at = self.buckets.get(key, (capacity, now, now))
+            allowed, tokens, retry_after = refill_and_take(tokens, now - updated, rate, capacity)
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+        return allowed, retry_after
+
+
+class SQLiteBucketStore:
+    """
+        Token buckets kept in a local SQLite file, so every worker on the same host shares one limit.
+        BEGIN IMMEDIATE serialises the read-modify-write across processes. Lock waits are capped at lock_timeout
+        seconds so contention can't stall ingest; past that, take() raises BucketStoreBusy.
+        Buckets that have refilled are deleted every sweep_interval seconds, as in MemoryBucketStore.
+
+    """
+
+    def __init__(self, path, sweep_interval=10, lock_timeout=0.05):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        self.local = threading.local()
+
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_token_buckets_full_at ON token_buckets (full_at)")
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            self.local.conn = conn
+
+        return conn
+
+    def take(self, key, rate, capacity):
+        conn = self.connect()
+        now = time.time()
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if now - self.last_sweep >= self.sweep_interval:
+                conn.execute("DELETE FROM token_buckets WHERE full_at <= ?", (now,))
+                self.last_sweep = now
+
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            allowed, tokens, retry_after = refill_and_take(tokens, max(now - updated, 0), rate, capacity)
+            conn.execute("INSERT OR REPLACE INTO token_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+            # Only lock contention is worth shedding for; a full or read-only disk or a missing table should surface.
+            if isinstance(e, sqlite3.OperationalError) and is_lock_error(e):
+                raise BucketStoreBusy(str(e)) from e
+            raise
+
+        return allowed, retry_after
+
+
+def is_lock_error(error):
+    """
+        True for SQLITE_BUSY / SQLITE_LOCKED, which Python only reports through the message.
+
+    """
+
+    message = str(error).lower()
+
+    return 'database is locked' in message or 'database table is locked' in message or 'busy' in message
+
+
+def refill_and_take(tokens, elapsed, rate, capacity):
+    """
+        Token bucket arithmetic shared by the stores.
+        Returns (allowed, remaining_tokens, retry_after_seconds).
+
+    """
+
+    tokens = min(capacity, tokens + elapsed * rate)
+
+    if tokens >= 1:
+        return True, tokens - 1, 0
+
+    return False, tokens, (1 - tokens) / rate
+
+
+class IngestLimiter:
+    """
+        Admission control for write-heavy routes.
+        Requests are checked against a per client IP bucket (429 when empty), then a cap on concurrent requests 
+        in this worker (503 when full) so we shed load before the DB pool runs dry, then a per user_id bucket (429).
+
+        The user_id comes from the unauthenticated body, so the user bucket is only charged when user_exists(user_id) 
+        is true; made-up ids can't grow the bucket store and are still held back by the IP bucket.
+
+    """
+
+    def __init__(self, store, rate, capacity, user_rate, user_capacity, max_concurrent, user_exists=None):
+        self.store = store
+        self.rate = rate
+        self.capacity = capacity
+        self.user_rate = user_rate
+        self.user_capacity = user_capacity
+        self.max_concurrent = max_concurrent
+        self.user_exists = user_exists
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.counts = {'allowed': 0, 'limited_ip': 0, 'limited_user': 0, 'shed': 0, 'store_busy': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counts, in_flight=self.in_flight, max_concurrent=self.max_concurrent,
+                        rate=self.rate, burst=self.capacity, user_rate=self.user_rate, user_burst=self.user_capacity)
+
+    def limit(self, route):
+        """
+            Decorator applying the IP and user buckets and the concurrency cap to a route.
+            The user_id is read from the JSON body when present.
+
+        """
+
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            try:
+                allowed, retry_after = self.store.take(f"ip:{request.remote_addr}", self.rate, self.capacity)
+            except BucketStoreBusy:
+                self.count('store_busy')
+                return rejected("Server busy, try again shortly.", 503, 1)
+
+            if not allowed:
+                self.count('limited_ip')
+                return rejected("Too many requests from this address.", 429, retry_after)
+
+            with self.lock:
+                if self.in_flight >= self.max_concurrent:
+                    self.counts['shed'] += 1
+                    return rejected("Server busy, try again shortly.", 503, 1)
+
+                self.in_flight += 1
+
+            try:
+                payload = request.get_json(silent=True)
+                user_id = payload.get('user_id') if isinstance(payload, dict) else None
+
+                if user_id is not None and (self.user_exists is None or self.user_exists(user_id)):
+                    try:
+                        allowed, retry_after = self.store.take(f"user:{user_id}", self.user_rate, self.user_capacity)
+                    except BucketStoreBusy:
+                        self.count('store_busy')
+                        return rejected("Server busy, try again shortly.", 503, 1)
+
+                    if not allowed:
+                        self.count('limited_user')
+                        return rejected("Too many requests for this user.", 429, retry_after)
+
+                self.count('allowed')
+                return route(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        return wrapper
+
+
+def rejected(message, status, retry_after):
+    resp = make_response(message, status)
+    resp.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+
+    return resp
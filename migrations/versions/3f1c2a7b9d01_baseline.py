@@ -0,0 +1,58 @@
+"""baseline schema: users, audio, ticks
+
+Revision ID: 3f1c2a7b9d01
+Revises: 
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7b9d01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created before migrations existed already have these tables from db.create_all().
+    existing = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'users' not in existing:
+        op.create_table('users',
+            sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column('name', sa.String(length=50), nullable=False),
+            sa.Column('email', sa.String(length=50), nullable=False),
+            sa.Column('address', sa.String(), nullable=False),
+            sa.Column('image', sa.String(length=100), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('email')
+        )
+
+    if 'audio' not in existing:
+        op.create_table('audio',
+            sa.Column('session_id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('selected_tick', sa.Integer(), nullable=False),
+            sa.Column('step_count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+            sa.PrimaryKeyConstraint('session_id'),
+            sa.UniqueConstraint('session_id')
+        )
+
+    if 'ticks' not in existing:
+        op.create_table('ticks',
+            sa.Column('ticks_id', sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column('session_id', sa.Integer(), nullable=False),
+            sa.Column('tick', sa.Numeric(), nullable=False),
+            sa.ForeignKeyConstraint(['session_id'], ['audio.session_id'], ondelete='cascade'),
+            sa.PrimaryKeyConstraint('ticks_id', 'session_id')
+        )
+
+
+def downgrade():
+    op.drop_table('ticks')
+    op.drop_table('audio')
+    op.drop_table('users')
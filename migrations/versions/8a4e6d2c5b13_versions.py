@@ -0,0 +1,34 @@
+"""version/updated_at columns on users and audio
+
+Revision ID: 8a4e6d2c5b13
+Revises: 3f1c2a7b9d01
+Create Date: 2026-10-19 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d2c5b13'
+down_revision = '3f1c2a7b9d01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table in ('users', 'audio'):
+        columns = [column['name'] for column in inspector.get_columns(table)]
+
+        if 'version' not in columns:
+            op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+        if 'updated_at' not in columns:
+            op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.text("timezone('utc', now())")))
+
+
+def downgrade():
+    for table in ('users', 'audio'):
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
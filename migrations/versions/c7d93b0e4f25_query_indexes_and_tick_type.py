@@ -0,0 +1,57 @@
+"""covering indexes for the app.py queries, ticks.tick as double precision
+
+Revision ID: c7d93b0e4f25
+Revises: e2b8f4a61c37
+Create Date: 2026-10-19 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d93b0e4f25'
+down_revision = 'e2b8f4a61c37'
+branch_labels = None
+depends_on = None
+
+
+# Kept in step with the __table_args__ in models.py. 
+# IF NOT EXISTS because db.create_all() may already have built them on a fresh database.
+INDEXES = [
+    ('ix_users_name_trgm', 'CREATE INDEX IF NOT EXISTS ix_users_name_trgm ON users USING gin (name gin_trgm_ops)'),
+    ('ix_users_email_trgm', 'CREATE INDEX IF NOT EXISTS ix_users_email_trgm ON users USING gin (email gin_trgm_ops)'),
+    ('ix_users_address_trgm', 'CREATE INDEX IF NOT EXISTS ix_users_address_trgm ON users USING gin (address gin_trgm_ops)'),
+    ('ix_audio_user_id', 'CREATE INDEX IF NOT EXISTS ix_audio_user_id ON audio (user_id)'),
+    ('ix_ticks_session_id', 'CREATE INDEX IF NOT EXISTS ix_ticks_session_id ON ticks (session_id, ticks_id) INCLUDE (tick)'),
+]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # Rewrite ticks before indexing them so the covering index is only built once.
+    op.alter_column('ticks', 'tick',
+        type_=sa.Float(precision=53),
+        existing_nullable=False,
+        postgresql_using='tick::double precision'
+    )
+
+    for name, ddl in INDEXES:
+        op.execute(ddl)
+
+    # The primary key already indexes audio.session_id; the extra unique constraint only added write cost.
+    op.execute('ALTER TABLE audio DROP CONSTRAINT IF EXISTS audio_session_id_key')
+
+
+def downgrade():
+    op.create_unique_constraint('audio_session_id_key', 'audio', ['session_id'])
+
+    for name, ddl in reversed(INDEXES):
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+
+    op.alter_column('ticks', 'tick',
+        type_=sa.Numeric(),
+        existing_nullable=False,
+        postgresql_using='tick::numeric'
+    )
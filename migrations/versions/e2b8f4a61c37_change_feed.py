@@ -0,0 +1,45 @@
+"""changes outbox and compaction state for the /api/changes feed
+
+Revision ID: e2b8f4a61c37
+Revises: 8a4e6d2c5b13
+Create Date: 2026-10-19 09:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8f4a61c37'
+down_revision = '8a4e6d2c5b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'changes' not in existing:
+        op.create_table('changes',
+            sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+            sa.Column('entity', sa.String(length=10), nullable=False),
+            sa.Column('entity_id', sa.Integer(), nullable=False),
+            sa.Column('action', sa.String(length=10), nullable=False),
+            sa.Column('payload', sa.JSON(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_changes_created_at', 'changes', ['created_at'])
+
+    if 'change_feed_state' not in existing:
+        op.create_table('change_feed_state',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('compacted_through', sa.BigInteger(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('change_feed_state')
+    op.drop_index('ix_changes_created_at', table_name='changes')
+    op.drop_table('changes')
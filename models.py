@@ -1,4 +1,6 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
 
 db = SQLAlchemy()
 
@@ -7,7 +9,25 @@ def connect_db(app):
     db.app = app
     db.init_app(app)
 
-class User(db.Model):
+class VersionedMixin:
+    """
+        Adds a "version" counter and an "updated_at" timestamp to a model.
+        The PATCH routes call touch() so GET routes can answer conditional requests
+        (ETag / Last-Modified) from these two columns without rendering the full row.
+
+    """
+
+    # The server defaults backfill existing rows when the columns are added; updated_at is kept in UTC like datetime.utcnow().
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text("timezone('utc', now())"))
+
+    def touch(self):
+        # Incremented in SQL (SET version = version + 1) so concurrent PATCHes each get their own version;
+        # the row lock makes the second UPDATE build on the first. The new value is reloaded on next access.
+        self.version = type(self).version + 1
+        self.updated_at = datetime.utcnow()
+
+class User(VersionedMixin, db.Model):
     """ 
         User Model includes id, name, email, address, image, and, by relation, audio data.
            
@@ -20,18 +40,29 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # The search routes use LIKE '%...%', which only a trigram index can serve.
+    __table_args__ = (
+        db.Index('ix_users_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        db.Index('ix_users_email_trgm', 'email', postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'}),
+        db.Index('ix_users_address_trgm', 'address', postgresql_using='gin', postgresql_ops={'address': 'gin_trgm_ops'}),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(50), nullable=False, unique=True)
     address = db.Column(db.String, nullable=False)
     image = db.Column(db.String(100), nullable=False)
-    audio = db.relationship('Audio')
+    # Deleting a user deletes their sessions in the ORM (so the routes can record them) 
+    # and leaves unloaded rows to the database's ON DELETE CASCADE.
+    audio = db.relationship('Audio', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"Name: {self.name}, Email: {self.email}, Address: {self.address}, Image: {self.image}"
 
+event.listen(User.__table__, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
 
-class Audio(db.Model):
+
+class Audio(VersionedMixin, db.Model):
     """ 
 
         Audio Model includes "session_id"(key), user_id(foreign key), "selected_tick", "step_count", and, by relation, "ticks".
@@ -40,7 +71,12 @@ class Audio(db.Model):
 
     __tablename__ = 'audio'
 
-    session_id = db.Column(db.Integer, primary_key=True, unique=True)
+    # Plain index: the PATCH route rewrites every other column, so INCLUDEing them would make each PATCH a non-HOT update.
+    __table_args__ = (
+        db.Index('ix_audio_user_id', 'user_id'),
+    )
+
+    session_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False )
     selected_tick = db.Column(db.Integer, nullable=False)
     step_count = db.Column(db.Integer, nullable=False)
@@ -65,15 +101,62 @@ class Tick(db.Model):
 
     __tablename__ = 'ticks'
 
+    # Every tick read filters on session_id and wants the ticks in insert order.
+    __table_args__ = (
+        db.Index('ix_ticks_session_id', 'session_id', 'ticks_id', postgresql_include=['tick']),
+    )
+
     ticks_id = db.Column(db.Integer, autoincrement=True)
     session_id = db.Column(db.Integer, db.ForeignKey('audio.session_id', ondelete='cascade'), nullable=False)
-    tick = db.Column(db.Numeric, nullable=False)
+    tick = db.Column(db.Float(precision=53), nullable=False)
     db.PrimaryKeyConstraint(ticks_id, session_id)
-    ticks = db.relationship('Audio', backref='ticks')
+    ticks = db.relationship('Audio', backref=db.backref('ticks', cascade='all, delete-orphan', passive_deletes=True))
 
 
     def compile_ticks_by_session(session_id):
-        ticks = Tick.query.filter(Tick.session_id == session_id).all()
+        ticks = Tick.query.filter(Tick.session_id == session_id).order_by(Tick.ticks_id).all()
         output = [float(t.tick) for t in ticks]
         return output
-        
\ No newline at end of file
+        
+
+class Change(db.Model):
+    """
+
+        Change is the transactional outbox behind the /api/changes feed.
+        Every write route adds a row in the same transaction as the write it describes.
+        "id" is the feed cursor; rows are committed in id order (see record_change in app.py).
+
+    """
+
+    __tablename__ = 'changes'
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    entity = db.Column(db.String(10), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def serialize(self):
+        return {
+            'cursor': self.id,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'action': self.action,
+            'payload': self.payload,
+            'created_at': self.created_at.isoformat()
+        }
+
+
+class ChangeFeedState(db.Model):
+    """
+
+        A single row (id 1) holding "compacted_through", the largest Change id that compact-changes has deleted.
+        A consumer whose cursor is below it has missed entries.
+
+    """
+
+    __tablename__ = 'change_feed_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    compacted_through = db.Column(db.BigInteger, nullable=False, default=0)
@@ -0,0 +1,182 @@
+import threading
+
+import numpy as np
+
+
+class TickIndex:
+    """
+        In-memory nearest neighbour index over each session's 15 tick values.
+
+        Rows live in a preallocated float32 matrix that doubles when full; "positions" maps a session_id to its row.
+        Removing a session moves the last row into the freed slot, so the live rows are always matrix[:size].
+        Queries are a brute force euclidean scan, which stays in the low milliseconds for a few hundred thousand sessions.
+
+        "cursor" is the last change feed id applied, so each worker can catch up on writes made through other workers.
+
+    """
+
+    def __init__(self, dimensions=15, capacity=1024):
+        self.dimensions = dimensions
+        self.matrix = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.session_ids = np.zeros(capacity, dtype=np.int64)
+        self.positions = {}
+        self.size = 0
+        self.loaded = False
+        self.cursor = 0
+        self.pending = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, session_id):
+        return session_id in self.positions
+
+    def rebuild(self, load):
+        """
+            Replaces the index contents with load(), which returns (cursor, rows of (session_id, ticks)).
+
+            load() runs without holding the index lock, into a fresh TickIndex. Upserts and removes that arrive 
+            meanwhile are queued and replayed onto the fresh rows before they are swapped in, so none are lost.
+            Only one build runs at a time.
+
+        """
+
+        with self.build_lock:
+            self._rebuild(load)
+
+    def ensure_loaded(self, load):
+        """
+            Builds the index on first use; concurrent first callers wait for a single build.
+
+        """
+
+        if self.loaded:
+            return
+
+        with self.build_lock:
+            if not self.loaded:
+                self._rebuild(load)
+
+    def _rebuild(self, load):
+        with self.lock:
+            self.pending = []
+
+        fresh = TickIndex(self.dimensions)
+
+        try:
+            cursor, rows = load()
+
+            for session_id, ticks in rows:
+                fresh._upsert(session_id, ticks)
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            for session_id, ticks in self.pending:
+                if ticks is None:
+                    fresh._remove(session_id)
+                else:
+                    fresh._upsert(session_id, ticks)
+
+            self.matrix, self.session_ids = fresh.matrix, fresh.session_ids
+            self.positions, self.size = fresh.positions, fresh.size
+            self.cursor = cursor
+            self.pending = None
+            self.loaded = True
+
+    def catch_up(self, changes):
+        """
+            Applies change feed entries (change_id, session_id, action, ticks) newer than the cursor, in order.
+            Deletes remove the session, entries with ticks replace its vector, and the rest only advance the cursor.
+
+        """
+
+        with self.build_lock, self.lock:
+            for change_id, session_id, action, ticks in changes:
+                if change_id <= self.cursor:
+                    continue
+
+                if action == 'delete':
+                    self._remove(session_id)
+                elif ticks is not None:
+                    self._upsert(session_id, ticks)
+
+                self.cursor = change_id
+
+    def upsert(self, session_id, ticks):
+        with self.lock:
+            self._upsert(session_id, ticks)
+
+            if self.pending is not None:
+                self.pending.append((session_id, ticks))
+
+    def _upsert(self, session_id, ticks):
+        if len(ticks) != self.dimensions:
+            return
+
+        row = self.positions.get(session_id)
+
+        if row is None:
+            if self.size == len(self.matrix):
+                self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                self.session_ids = np.concatenate([self.session_ids, np.zeros_like(self.session_ids)])
+
+            row = self.size
+            self.size += 1
+            self.positions[session_id] = row
+            self.session_ids[row] = session_id
+
+        self.matrix[row] = ticks
+
+    def remove(self, session_id):
+        with self.lock:
+            self._remove(session_id)
+
+            if self.pending is not None:
+                self.pending.append((session_id, None))
+
+    def _remove(self, session_id):
+        row = self.positions.pop(session_id, None)
+
+        if row is None:
+            return
+
+        last = self.size - 1
+
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.session_ids[row] = self.session_ids[last]
+            self.positions[int(self.session_ids[row])] = row
+
+        self.size = last
+
+    def similar(self, session_id, k):
+        """
+            Returns up to k (session_id, distance) pairs closest to the given session, nearest first.
+            The session itself is excluded.
+
+        """
+
+        with self.lock:
+            row = self.positions.get(session_id)
+
+            if row is None:
+                return []
+
+            distances = np.linalg.norm(self.matrix[:self.size] - self.matrix[row], axis=1)
+            session_ids = self.session_ids[:self.size].copy()
+
+        distances[row] = np.inf
+        k = min(k, self.size - 1)
+
+        if k <= 0:
+            return []
+
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+
+        return [(int(session_ids[i]), float(distances[i])) for i in nearest]
@@ -1,6 +1,8 @@
 import os
+import time
+import threading
 from unittest import TestCase
-from models import db, User, Audio, Tick
+from models import db, User, Audio, Tick, Change
 
 # This DATABASE_URL will cause testing faiures. 
 # The host "db" can't be found, but I am unsure how to correctly reference the db container's host ip.
@@ -171,3 +173,231 @@ class AppTest(TestCase):
             self.assertIn('waldo', html)
            
 
+
+    def test_get_user_not_modified(self):
+        """
+            Does a GET with a matching ETag return a 304, and a fresh body after a PATCH?
+
+        """
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=rafiki&email=rafiki%40email.com&address=Pride%20Rock&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(name='rafiki').first().id
+
+            resp = client.get(f"/api/users/{user_id}")
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            self.assertIsNotNone(resp.headers.get('Last-Modified'))
+
+            resp = client.get(f"/api/users/{user_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(as_text=True), '')
+
+            resp = client.patch(f"/api/users/{user_id}?name=simba", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get(f"/api/users/{user_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertIn('simba', resp.get_data(as_text=True))
+
+    def test_change_feed(self):
+        """
+            Do user writes show up on the change feed in order, after the consumer's cursor?
+
+            Read the current cursor. Create, patch, and delete a user.
+            Check the feed returns exactly those three changes.
+        """
+
+        with app.test_client() as client:
+
+            cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+
+            resp = client.post('/api/users?name=nala&email=nala%40email.com&address=Pride%20Rock&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(name='nala').first().id
+
+            client.patch(f"/api/users/{user_id}?address=Jungle", follow_redirects=True)
+            client.delete(f"/api/users/{user_id}", follow_redirects=True)
+
+            resp = client.get(f"/api/changes?since={cursor}")
+            self.assertEqual(resp.status_code, 200)
+            feed = resp.get_json()
+
+            self.assertEqual([c['action'] for c in feed['changes']], ['create', 'update', 'delete'])
+            self.assertTrue(all(c['entity_id'] == user_id for c in feed['changes']))
+            self.assertEqual(feed['changes'][1]['payload']['address'], 'Jungle')
+
+            resp = client.get(f"/api/changes?since={feed['cursor']}")
+            self.assertEqual(resp.get_json()['changes'], [])
+
+    def test_change_feed_user_with_audio(self):
+        """
+            Does deleting a user with sessions succeed and put both deletes on the change feed?
+
+            Create a user and a session. Delete the user.
+            Check the session and its ticks are gone and the feed has the audio and user deletes.
+        """
+
+        with app.test_client() as client:
+
+            cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+
+            resp = client.post('/api/users?name=scar&email=scar%40email.com&address=Elephant%20Graveyard&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(name='scar').first().id
+
+            payload = f"{{\"user_id\": {user_id},\n \"ticks\": [-66.33, -66.33, -63.47, -69.03999999999999, -84.61, -80.18, -75.75, -71.32, -66.89, -62.46, -58.03, -53.6, -49.17, -44.74, -40.31], \"selected_tick\": 5, \"session_id\": 33333, \"step_count\": 0\n}}"
+
+            resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.delete(f"/api/users/{user_id}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(Audio.query.get(33333))
+            self.assertEqual(Tick.query.filter(Tick.session_id == 33333).count(), 0)
+
+            resp = client.get(f"/api/changes?since={cursor}")
+            changes = [(c['entity'], c['entity_id'], c['action']) for c in resp.get_json()['changes']]
+
+            self.assertIn(('audio', 33333, 'delete'), changes)
+            self.assertIn(('user', user_id, 'delete'), changes)
+
+    def test_change_feed_truncated_after_compaction(self):
+        """
+            After compaction, is a consumer behind the compacted entries told to rescan, and a caught-up one not?
+
+        """
+
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=zazu&email=zazu%40email.com&address=Pride%20Rock&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            cursor = db.session.query(db.func.max(Change.id)).scalar()
+
+            os.environ['CHANGE_RETENTION_DAYS'] = '0'
+            try:
+                result = app.test_cli_runner().invoke(args=['compact-changes'])
+            finally:
+                del os.environ['CHANGE_RETENTION_DAYS']
+
+            self.assertIn('Compacted', result.output)
+
+            resp = client.get('/api/changes?since=0')
+            self.assertTrue(resp.get_json()['truncated'])
+
+            resp = client.get(f"/api/changes?since={cursor}")
+            self.assertFalse(resp.get_json()['truncated'])
+
+    def test_concurrent_patches_get_distinct_versions(self):
+        """
+            If two sessions load the same user and both PATCH it, does each commit get its own version?
+
+        """
+
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=timon2&email=timon2%40email.com&address=9%20ash%20court&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(name='timon2').first().id
+
+        first, second = db.create_scoped_session(), db.create_scoped_session()
+
+        try:
+            # Both sessions read the same starting version before either writes.
+            first_user = first.query(User).get(user_id)
+            second_user = second.query(User).get(user_id)
+            self.assertEqual(first_user.version, second_user.version)
+
+            first_user.name = 'pumbaa2'
+            first_user.touch()
+            first.commit()
+            first_version = first_user.version
+
+            second_user.address = 'Hakuna Matata'
+            second_user.touch()
+            second.commit()
+
+            self.assertNotEqual(first_version, second_user.version)
+            self.assertEqual(second_user.version, first_version + 1)
+        finally:
+            first.remove()
+            second.remove()
+
+    def test_change_feed_long_poll_returns_new_entry(self):
+        """
+            Does a long-poll return a change written while it is waiting, before the wait runs out?
+
+        """
+
+        cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+
+        def write_later():
+            with app.app_context(), app.test_client() as writer:
+                writer.post('/api/users?name=mufasa&email=mufasa%40email.com&address=Pride%20Rock&image=pictureofme.com/image.jpg')
+
+        writer = threading.Timer(0.5, write_later)
+        writer.start()
+
+        try:
+            with app.test_client() as client:
+
+                started = time.monotonic()
+                resp = client.get(f"/api/changes?since={cursor}&wait=10")
+                elapsed = time.monotonic() - started
+        finally:
+            writer.join()
+
+        feed = resp.get_json()
+
+        self.assertLess(elapsed, 10)
+        self.assertEqual([c['action'] for c in feed['changes']], ['create'])
+        self.assertEqual(feed['changes'][0]['payload']['name'], 'mufasa')
+        self.assertEqual(feed['cursor'], feed['changes'][0]['cursor'])
+
+    def test_change_feed_long_poll_times_out(self):
+        """
+            With no writes, does a long-poll wait out its time and return an empty page with the cursor unchanged?
+
+        """
+
+        cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+
+        with app.test_client() as client:
+
+            started = time.monotonic()
+            resp = client.get(f"/api/changes?since={cursor}&wait=1")
+            elapsed = time.monotonic() - started
+
+        self.assertGreaterEqual(elapsed, 1)
+        self.assertEqual(resp.get_json()['changes'], [])
+        self.assertEqual(resp.get_json()['cursor'], cursor)
+
+    def test_change_feed_limit_clamped(self):
+        """
+            Is "limit" clamped to 1-1000, paging through entries in order?
+
+        """
+
+        cursor = db.session.query(db.func.max(Change.id)).scalar() or 0
+
+        with app.test_client() as client:
+
+            for name in ('kiara', 'kovu'):
+                resp = client.post(f"/api/users?name={name}&email={name}%40email.com&address=Pride%20Rock&image=pictureofme.com/image.jpg")
+                self.assertEqual(resp.status_code, 200)
+
+            first = client.get(f"/api/changes?since={cursor}&limit=0").get_json()
+            self.assertEqual([c['payload']['name'] for c in first['changes']], ['kiara'])
+
+            second = client.get(f"/api/changes?since={first['cursor']}&limit=-5").get_json()
+            self.assertEqual([c['payload']['name'] for c in second['changes']], ['kovu'])
+
+            resp = client.get(f"/api/changes?since={cursor}&limit=5000")
+            self.assertEqual(len(resp.get_json()['changes']), 2)
@@ -1,6 +1,10 @@
 import os
+import json
+import time
+import sqlite3
+import tempfile
 from unittest import TestCase
-from models import db, User, Audio, Tick
+from models import db, User, Audio, Tick, Change
 
 # This DATABASE_URL will cause testing faiures. 
 # The host "db" can't be found, but I am unsure how to correctly reference the db container's host ip.
@@ -12,7 +16,9 @@ from models import db, User, Audio, Tick
 # For offline local testing. 
 os.environ['DATABASE_URL'] = "postgresql:///cl_backend_test"
 
-from app import app
+from app import app, limiter, load_tick_index, tick_index
+from similarity import TickIndex
+from limits import MemoryBucketStore, SQLiteBucketStore, BucketStoreBusy
 
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -135,3 +141,367 @@ class AppTest(TestCase):
             self.assertEqual(resp.status_code, 200)
             html = resp.get_data(as_text=True)
             self.assertIn(f"Ticks: [-11", html)
+
+    def test_get_audio_not_modified(self):
+        """
+            Does a session GET with a matching ETag return a 304 until the session is patched?
+
+        """
+
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=Bob%20Marley&email=jamaica%40email.com&address=Sandy%20Beaches&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(email='jamaica@email.com').first().id
+
+            payload = f"{{\"user_id\": {user_id},\n \"ticks\": [-66.33, -66.33, -63.47, -69.03999999999999, -84.61, -80.18, -75.75, -71.32, -66.89, -62.46, -58.03, -53.6, -49.17, -44.74, -40.31], \"selected_tick\": 5, \"session_id\": 66666, \"step_count\": 0\n}}"
+
+            resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/66666')
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+
+            resp = client.get('/api/audio/session/66666', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.patch("/api/audio/update/66666?step_count=3", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/66666', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Step Count: 3', resp.get_data(as_text=True))
+
+    def test_audio_rate_limited(self):
+        """
+            Does a client address posting faster than its burst allowance get a 429 with Retry-After?
+
+        """
+
+        original = (limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity)
+        limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity = MemoryBucketStore(), 0.01, 2, 100, 100
+        limited_ip = limiter.metrics()['limited_ip']
+
+        try:
+            with app.test_client() as client:
+
+                resp = client.post('/api/users?name=Bob%20Marley&email=jamaica%40email.com&address=Sandy%20Beaches&image=pictureofme.com/image.jpg', follow_redirects=True)
+                self.assertEqual(resp.status_code, 200)
+
+                user_id = User.query.filter_by(email='jamaica@email.com').first().id
+
+                for session_id in (55551, 55552):
+                    payload = f"{{\"user_id\": {user_id},\n \"ticks\": [-66.33, -66.33, -63.47, -69.03999999999999, -84.61, -80.18, -75.75, -71.32, -66.89, -62.46, -58.03, -53.6, -49.17, -44.74, -40.31], \"selected_tick\": 5, \"session_id\": {session_id}, \"step_count\": 0\n}}"
+                    resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                    self.assertEqual(resp.status_code, 200)
+
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn('Retry-After', resp.headers)
+
+                resp = client.get('/api/metrics')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json()['limited_ip'], limited_ip + 1)
+        finally:
+            limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity = original
+
+    def test_audio_user_rate_limited(self):
+        """
+            Does a single user posting faster than the per user allowance get a 429, while the address bucket still has room?
+
+        """
+
+        original = (limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity)
+        limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity = MemoryBucketStore(), 100, 100, 0.01, 1
+        counts = limiter.metrics()
+
+        try:
+            with app.test_client() as client:
+
+                resp = client.post('/api/users?name=Bob%20Marley&email=jamaica%40email.com&address=Sandy%20Beaches&image=pictureofme.com/image.jpg', follow_redirects=True)
+                self.assertEqual(resp.status_code, 200)
+
+                user_id = User.query.filter_by(email='jamaica@email.com').first().id
+
+                for session_id, status in ((55553, 200), (55554, 429)):
+                    payload = json.dumps({"user_id": user_id, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": session_id, "step_count": 0})
+                    resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                    self.assertEqual(resp.status_code, status)
+
+                self.assertIn('Retry-After', resp.headers)
+
+                metrics = client.get('/api/metrics').get_json()
+                self.assertEqual(metrics['limited_user'], counts['limited_user'] + 1)
+                self.assertEqual(metrics['limited_ip'], counts['limited_ip'])
+        finally:
+            limiter.store, limiter.rate, limiter.capacity, limiter.user_rate, limiter.user_capacity = original
+
+    def test_similar_sessions(self):
+        """
+            Does the similarity route rank the session with the closest tick curve first?
+
+            Create a user with three sessions, two with nearly identical ticks.
+            Check the near twin is returned first and the session itself is excluded.
+        """
+
+        load_tick_index()
+
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=Bob%20Marley&email=jamaica%40email.com&address=Sandy%20Beaches&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(email='jamaica@email.com').first().id
+
+            for session_id, tick in ((44441, -20.0), (44442, -21.0), (44443, -90.0)):
+                payload = json.dumps({"user_id": user_id, "ticks": [tick] * 15, "selected_tick": 5, "session_id": session_id, "step_count": 0})
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/44441/similar?k=2')
+            self.assertEqual(resp.status_code, 200)
+            similar = [s['session_id'] for s in resp.get_json()['similar']]
+            self.assertEqual(similar, [44442, 44443])
+
+            resp = client.get('/api/audio/session/8675309/similar')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_similar_sessions_after_user_delete(self):
+        """
+            Do a deleted user's sessions drop out of similarity results?
+
+            Create two users with one session each. Delete the second user.
+            Check the first session no longer lists the deleted one, and the deleted one 404s.
+        """
+
+        load_tick_index()
+
+        with app.test_client() as client:
+
+            for name in ('Peter', 'Bunny'):
+                resp = client.post(f"/api/users?name={name}&email={name}%40email.com&address=Trenchtown&image=pictureofme.com/image.jpg", follow_redirects=True)
+                self.assertEqual(resp.status_code, 200)
+
+            peter = User.query.filter_by(name='Peter').first().id
+            bunny = User.query.filter_by(name='Bunny').first().id
+
+            for user_id, session_id in ((peter, 22221), (bunny, 22222)):
+                payload = json.dumps({"user_id": user_id, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": session_id, "step_count": 0})
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/22221/similar?k=100')
+            self.assertIn(22222, [s['session_id'] for s in resp.get_json()['similar']])
+
+            resp = client.delete(f"/api/users/{bunny}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/22221/similar?k=100')
+            self.assertNotIn(22222, [s['session_id'] for s in resp.get_json()['similar']])
+
+            resp = client.get('/api/audio/session/22222/similar')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_update_audio_change_payload(self):
+        """
+            Does an audio PATCH put integer step_count/selected_tick on the change feed, like a POST does?
+
+        """
+
+        with app.test_client() as client:
+
+            resp = client.post('/api/users?name=Bob%20Marley&email=jamaica%40email.com&address=Sandy%20Beaches&image=pictureofme.com/image.jpg', follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            user_id = User.query.filter_by(email='jamaica@email.com').first().id
+
+            payload = json.dumps({"user_id": user_id, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": 11111, "step_count": 0})
+            resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+            cursor = db.session.query(db.func.max(Change.id)).scalar()
+
+            resp = client.patch("/api/audio/update/11111?step_count=3&selected_tick=9", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            change = client.get(f"/api/changes?since={cursor}").get_json()['changes'][0]
+            self.assertEqual(change['action'], 'update')
+            self.assertEqual(change['payload']['step_count'], 3)
+            self.assertEqual(change['payload']['selected_tick'], 9)
+
+    def test_rate_limit_buckets_evicted(self):
+        """
+            Are refilled buckets swept out, and do unknown user_ids never get a bucket?
+
+        """
+
+        store = MemoryBucketStore(sweep_interval=0)
+
+        for key in range(100):
+            store.take(f"user:{key}", 1000, 1)
+
+        time.sleep(0.01)
+        store.take("user:last", 1000, 1)
+        self.assertEqual(list(store.buckets), ["user:last"])
+
+        original = limiter.store
+        limiter.store = MemoryBucketStore()
+
+        try:
+            with app.test_client() as client:
+
+                payload = json.dumps({"user_id": 8675309, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": 12121, "step_count": 0})
+                client.post(f"/api/audio", data = payload, content_type='application/json')
+
+                self.assertNotIn("user:8675309", limiter.store.buckets)
+        finally:
+            limiter.store = original
+
+    def test_busy_bucket_store_sheds(self):
+        """
+            If the bucket store can't answer in time, is the request shed with a 503 and counted?
+
+        """
+
+        class BusyStore:
+            def take(self, key, rate, capacity):
+                raise BucketStoreBusy("database is locked")
+
+        original = limiter.store
+        limiter.store = BusyStore()
+        store_busy = limiter.metrics()['store_busy']
+
+        try:
+            with app.test_client() as client:
+
+                payload = json.dumps({"user_id": 1, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": 13131, "step_count": 0})
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('Retry-After', resp.headers)
+                self.assertEqual(limiter.metrics()['store_busy'], store_busy + 1)
+        finally:
+            limiter.store = original
+
+    def test_tick_index_rebuild_keeps_concurrent_writes(self):
+        """
+            Are upserts and removes that land while the index is being rebuilt kept?
+
+        """
+
+        index = TickIndex()
+
+        def load():
+            # Another request commits session 9 and drops session 1 while the rows are being read.
+            index.upsert(9, [-90.0] * 15)
+            index.remove(1)
+            return 5, [(1, [-10.0] * 15), (2, [-20.0] * 15)]
+
+        index.rebuild(load)
+
+        self.assertIn(9, index)
+        self.assertIn(2, index)
+        self.assertNotIn(1, index)
+        self.assertEqual(index.cursor, 5)
+
+    def test_similar_sessions_catch_up_from_feed(self):
+        """
+            Does the index pick up tick updates and deletes it never saw directly, as if made through another worker?
+
+            Create three sessions and query once. Patch one session's ticks and delete another's user,
+            then put this worker's copy back to the stale state. The next query should reflect both writes.
+        """
+
+        load_tick_index()
+
+        with app.test_client() as client:
+
+            for name in ('Rita', 'Ziggy'):
+                resp = client.post(f"/api/users?name={name}&email={name}%40email.com&address=Kingston&image=pictureofme.com/image.jpg", follow_redirects=True)
+                self.assertEqual(resp.status_code, 200)
+
+            rita = User.query.filter_by(name='Rita').first().id
+            ziggy = User.query.filter_by(name='Ziggy').first().id
+
+            for user_id, session_id, tick in ((rita, 21211, -20.0), (rita, 21212, -90.0), (ziggy, 21213, -21.0)):
+                payload = json.dumps({"user_id": user_id, "ticks": [tick] * 15, "selected_tick": 5, "session_id": session_id, "step_count": 0})
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+                self.assertEqual(resp.status_code, 200)
+
+            resp = client.get('/api/audio/session/21211/similar?k=1')
+            self.assertEqual([s['session_id'] for s in resp.get_json()['similar']], [21213])
+
+            ticks = ",".join(["-20.5"] * 15)
+            resp = client.patch(f"/api/audio/update/21212?ticks={ticks}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.delete(f"/api/users/{ziggy}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            # Undo the local refresh, as if both writes had gone through a different worker.
+            tick_index.upsert(21212, [-90.0] * 15)
+            tick_index.upsert(21213, [-21.0] * 15)
+
+            resp = client.get('/api/audio/session/21211/similar?k=100')
+            similar = [s['session_id'] for s in resp.get_json()['similar']]
+
+            self.assertEqual(similar[0], 21212)
+            self.assertNotIn(21213, similar)
+
+    def test_concurrency_cap_sheds(self):
+        """
+            With max_concurrent ingests already in flight, is the next one shed with a 503 and counted?
+
+        """
+
+        original = (limiter.store, limiter.in_flight)
+        limiter.store = MemoryBucketStore()
+        limiter.in_flight = limiter.max_concurrent
+        shed = limiter.metrics()['shed']
+
+        try:
+            with app.test_client() as client:
+
+                payload = json.dumps({"user_id": 1, "ticks": [-30.0] * 15, "selected_tick": 5, "session_id": 14141, "step_count": 0})
+                resp = client.post(f"/api/audio", data = payload, content_type='application/json')
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers['Retry-After'], '1')
+                self.assertEqual(limiter.metrics()['shed'], shed + 1)
+                self.assertEqual(limiter.metrics()['in_flight'], limiter.max_concurrent)
+                self.assertIsNone(Audio.query.get(14141))
+        finally:
+            limiter.store, limiter.in_flight = original
+
+    def test_sqlite_bucket_store(self):
+        """
+            Does the shared SQLite store empty its buckets, report a held lock as busy, and raise other errors?
+
+        """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets.db')
+            store = SQLiteBucketStore(path)
+
+            self.assertEqual([store.take('user:1', 0.01, 2)[0] for _ in range(3)], [True, True, False])
+            self.assertGreater(store.take('user:1', 0.01, 2)[1], 0)
+
+            # A second store on the same file shares the buckets, as another worker would.
+            self.assertFalse(SQLiteBucketStore(path).take('user:1', 0.01, 2)[0])
+
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+
+            with self.assertRaises(BucketStoreBusy):
+                store.take('user:2', 0.01, 2)
+
+            other.execute("ROLLBACK")
+            self.assertTrue(store.take('user:2', 0.01, 2)[0])
+
+            other.execute("DROP TABLE token_buckets")
+            other.close()
+
+            with self.assertRaises(sqlite3.OperationalError):
+                store.take('user:3', 0.01, 2)
@@ -0,0 +1,137 @@
+import os
+from unittest import TestCase
+from sqlalchemy import text
+from models import db, User, Audio, Tick, Change
+
+# For offline local testing.
+os.environ['DATABASE_URL'] = "postgresql:///cl_backend_test"
+
+from app import app
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+# Large enough that the planner prefers an index over a sequential scan for every query below.
+SEED = [
+    """INSERT INTO users (name, email, address, image, version, updated_at)
+       SELECT 'user' || g, 'user' || g || '@email.com', g || ' maple lane', 'pictureofme.com/image.jpg', 1, now()
+       FROM generate_series(1, 20000) g""",
+    """INSERT INTO audio (session_id, user_id, selected_tick, step_count, version, updated_at)
+       SELECT g, g % 20000 + 1, g % 15, g % 10, 1, now()
+       FROM generate_series(1, 100000) g""",
+    """INSERT INTO ticks (session_id, tick)
+       SELECT s, -10 - random() * 90
+       FROM generate_series(1, 100000) s, generate_series(1, 15) t""",
+    """INSERT INTO changes (entity, entity_id, action, payload, created_at)
+       SELECT 'audio', g, 'create', '{}', now()
+       FROM generate_series(1, 100000) g""",
+]
+
+
+def index_names(plan):
+    """
+        Collects every index a JSON EXPLAIN plan node, or any of its children, scans.
+
+    """
+
+    names = {plan['Index Name']} if 'Index Name' in plan else set()
+
+    for child in plan.get('Plans', []):
+        names |= index_names(child)
+
+    return names
+
+
+class IndexTest(TestCase):
+    """
+        Runs EXPLAIN ANALYZE on the queries app.py issues against a seeded dataset
+        and checks each one is served by the index added for it.
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.execute(text("TRUNCATE users, audio, ticks, changes RESTART IDENTITY CASCADE"))
+
+        for statement in SEED:
+            db.session.execute(text(statement))
+
+        db.session.commit()
+
+        # VACUUM sets the visibility map, which index-only scans on the covering indexes depend on.
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("VACUUM ANALYZE"))
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.execute(text("TRUNCATE users, audio, ticks, changes RESTART IDENTITY CASCADE"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def explain(self, query):
+        """
+            Returns the top plan node of EXPLAIN ANALYZE for an ORM query.
+
+        """
+
+        sql = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+
+        return db.session.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}")).scalar()[0]['Plan']
+
+    def test_ticks_by_session_uses_index(self):
+        """
+            Does Tick.compile_ticks_by_session read ticks through ix_ticks_session_id?
+        """
+
+        plan = self.explain(Tick.query.filter(Tick.session_id == 4321).order_by(Tick.ticks_id))
+
+        self.assertIn('ix_ticks_session_id', index_names(plan))
+        self.assertEqual(plan['Node Type'], 'Index Only Scan')
+
+    def test_audio_by_user_uses_index(self):
+        """
+            Does get_audio_data_by_user filter through ix_audio_user_id?
+        """
+
+        plan = self.explain(Audio.query.filter(Audio.user_id == 1234))
+
+        self.assertIn('ix_audio_user_id', index_names(plan))
+
+    def test_version_lookups_use_primary_keys(self):
+        """
+            Are the conditional GET version lookups a single primary key probe?
+        """
+
+        plan = self.explain(db.session.query(Audio.version, Audio.updated_at).filter(Audio.session_id == 4321))
+        self.assertEqual(index_names(plan), {'audio_pkey'})
+
+        plan = self.explain(db.session.query(User.version, User.updated_at).filter(User.id == 1234))
+        self.assertEqual(index_names(plan), {'users_pkey'})
+
+    def test_user_searches_use_trigram_indexes(self):
+        """
+            Do the %LIKE% search routes use the trigram indexes instead of scanning users?
+        """
+
+        plan = self.explain(User.query.filter(User.name.like("%user12345%")))
+        self.assertIn('ix_users_name_trgm', index_names(plan))
+
+        plan = self.explain(User.query.filter(User.email.like("%user12345@email%")))
+        self.assertIn('ix_users_email_trgm', index_names(plan))
+
+        plan = self.explain(User.query.filter(User.address.like("%12345 maple%")))
+        self.assertIn('ix_users_address_trgm', index_names(plan))
+
+    def test_change_feed_uses_primary_key(self):
+        """
+            Does a change feed page read forward from the cursor on the primary key?
+        """
+
+        plan = self.explain(Change.query.filter(Change.id > 99000).order_by(Change.id).limit(100))
+
+        self.assertIn('changes_pkey', index_names(plan))